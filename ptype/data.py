@@ -3,12 +3,13 @@ import glob
 import logging
 import numpy as np
 import pandas as pd
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
 from tqdm import tqdm
 from joblib import Parallel, delayed
 from sklearn.preprocessing import (
     StandardScaler,
     MinMaxScaler,
-    OneHotEncoder,
     LabelEncoder,
     RobustScaler,
     QuantileTransformer,
@@ -20,6 +21,21 @@ from sklearn.model_selection import GroupShuffleSplit
 logger = logging.getLogger(__name__)
 
 
+def _fast_read_parquet(path, filters=None):
+    """
+    Read a memory-mapped parquet file with pyarrow's multi-threaded reader, releasing arrow buffers as columns are
+    converted to pandas. Blocks are consolidated (no split_blocks) because callers insert columns into the returned
+    frames, which on a one-block-per-column frame of ~300 columns is slow and warns about fragmentation.
+    Args:
+        path (str): Path to parquet file
+        filters (pyarrow.compute.Expression): Optional row filter applied while scanning
+    Returns:
+        Pandas DataFrame
+    """
+    table = pq.read_table(path, filters=filters, use_threads=True, memory_map=True)
+    return table.to_pandas(self_destruct=True)
+
+
 def load_ptype_data(
     data_path,
     source,
@@ -29,9 +45,12 @@ def load_ptype_data(
     val_end="20200909",
     test_start="20200910",
     test_end="20210501",
+    n_jobs=1,
+    verbose=1,
 ):
     """
-    Load Precip Type data
+    Load Precip Type data. Supports parallel loading with joblib. Each split covers the available dates between its
+    start and end (inclusive); each date is loaded once even if data_path holds files from several sources.
     Args:
         data_path (str): Path to data
         source (str): Precip observation source. Supports 'ASOS' or 'mPING'.
@@ -41,22 +60,42 @@ def load_ptype_data(
         val_end (str): Valid split end date (format yyyymmdd).
         test_start (str): Test split start date (format yyyymmdd).
         test_end (str): Test split end date (format yyyymmdd).
+        n_jobs (int): Number of parallel threads to use for data loading (default 1)
+        verbose (int): verbose level
     Returns:
     Dictionary of Pandas dataframes of training / validation / test data
+    Raises:
+        ValueError: If any of the six split boundary dates has no data file in data_path.
     """
 
-    dates = sorted([x[-16:-8] for x in os.listdir(data_path)])
+    # Unique dates, so directories holding files from several sources list each date once
+    dates = np.array(sorted({x[-16:-8] for x in os.listdir(data_path)}))
+    boundaries = [train_start, train_end, val_start, val_end, test_start, test_end]
+    idx = np.searchsorted(dates, boundaries)
+    for date, i in zip(boundaries, idx):
+        if i == dates.size or dates[i] != date:
+            raise ValueError(f"No data file found for split boundary date {date} in {data_path}")
 
     data = {}
-    data["train"] = dates[dates.index(train_start) : dates.index(train_end) + 1]
-    data["val"] = dates[dates.index(val_start) : dates.index(val_end) + 1]
-    data["test"] = dates[dates.index(test_start) : dates.index(test_end) + 1]
+    for split, i0, i1 in zip(["train", "val", "test"], idx[0::2], idx[1::2]):
+        data[split] = dates[i0:i1 + 1].tolist()
 
     for split in data.keys():
         dfs = []
-        for date in tqdm(data[split], desc=f"{split}"):
-            f = f"{source}_rap_{date}.parquet"
-            dfs.append(pd.read_parquet(os.path.join(data_path, f)))
+        if n_jobs == 1:
+            for date in tqdm(data[split], desc=f"{split}"):
+                f = f"{source}_rap_{date}.parquet"
+                dfs.append(_fast_read_parquet(os.path.join(data_path, f)))
+        else:
+            # pyarrow releases the GIL while decoding, so threads avoid pickling large frames between processes
+            dfs = Parallel(n_jobs=n_jobs, prefer="threads", verbose=verbose)(
+                [
+                    delayed(_fast_read_parquet)(
+                        os.path.join(data_path, f"{source}_rap_{date}.parquet")
+                    )
+                    for date in data[split]
+                ]
+            )
         data[split] = pd.concat(dfs, ignore_index=True)
 
     return data
@@ -64,38 +103,31 @@ def load_ptype_data(
 
 def load_ptype_uq(conf, data_split=0, verbose=0, drop_mixed=False):
 
-    # Load
-    df = pd.read_parquet(conf["data_path"])
+    # Load with the QC-Filter pushed down to the parquet reader
+    qc_value = str(conf["qc"])
+    qc_filter = (pads.field(f"wetbulb{qc_value}_filter") == 0.0) & (pads.field("usa") == 1.0)
+    df = _fast_read_parquet(conf["data_path"], filters=qc_filter)
 
     # Drop mixed cases
     if drop_mixed:
         logger.info("Dropping data points with mixed observations")
-        c1 = df["ra_percent"] == 1.0
-        c2 = df["sn_percent"] == 1.0
-        c3 = df["pl_percent"] == 1.0
-        c4 = df["fzra_percent"] == 1.0
-        condition = c1 | c2 | c3 | c4
-        df = df[condition].copy()
-
-    # QC-Filter
-    qc_value = str(conf["qc"])
-    cond1 = df[f"wetbulb{qc_value}_filter"] == 0.0
-    cond2 = df["usa"] == 1.0
-    dg = df[cond1 & cond2].copy()
+        ptype_percents = df[["ra_percent", "sn_percent", "pl_percent", "fzra_percent"]].to_numpy()
+        condition = (ptype_percents == 1.0).any(axis=1)
+        df = df.take(np.flatnonzero(condition))
 
-    dg["day"] = dg["datetime"].apply(lambda x: str(x).split(" ")[0])
-    dg["id"] = range(dg.shape[0])
+    df["day"] = pd.to_datetime(df["datetime"]).values.astype("datetime64[D]").astype(str)
+    df["id"] = range(df.shape[0])
 
     # Select test cases
-    test_days_c1 = dg["day"].isin(
+    test_days_c1 = df["day"].isin(
         [day for case in conf["case_studies"].values() for day in case]
     )
-    test_days_c2 = dg["day"] >= conf["test_cutoff"]
-    test_condition = test_days_c1 | test_days_c2
+    test_days_c2 = df["day"] >= conf["test_cutoff"]
+    test_condition = (test_days_c1 | test_days_c2).to_numpy()
 
     # Partition the data into trainable-only and test-only splits
-    train_data = dg[~test_condition].copy()
-    test_data = dg[test_condition].copy()
+    train_data = df.take(np.flatnonzero(~test_condition))
+    test_data = df.take(np.flatnonzero(test_condition))
 
     # Make N train-valid splits using day as grouping variable, return "data_split" split
     gsp = GroupShuffleSplit(
@@ -107,8 +139,8 @@ def load_ptype_uq(conf, data_split=0, verbose=0, drop_mixed=False):
 
     train_index, valid_index = splits[data_split]
     train_data, valid_data = (
-        train_data.iloc[train_index].copy(),
-        train_data.iloc[valid_index].copy(),
+        train_data.take(train_index),
+        train_data.take(valid_index),
     )
 
     size = df.shape[0]
@@ -150,12 +182,12 @@ def load_ptype_data_subset(
         for date in tqdm(selected_dates):
             date_str = date.strftime("%Y%m%d")
             filename = f"{source}_rap_{date_str}.parquet"
-            dfs.append(pd.read_parquet(os.path.join(data_path, filename)))
+            dfs.append(_fast_read_parquet(os.path.join(data_path, filename)))
     else:
         date_strs = selected_dates.strftime("%Y%m%d")
         dfs = Parallel(n_jobs=n_jobs, verbose=verbose)(
             [
-                delayed(pd.read_parquet)(
+                delayed(_fast_read_parquet)(
                     os.path.join(data_path, f"{source}_rap_{date_str}.parquet")
                 )
                 for date_str in date_strs
@@ -168,41 +200,37 @@ def load_ptype_data_subset(
 def load_ptype_data_day(conf, data_split=0, verbose=0, drop_mixed=False):
 
     if "parquet" in conf["data_path"]:
-        df = pd.read_parquet(conf["data_path"])
         # cond1 = (df["datetime"].apply(lambda x: str(x).split(" ")[0]) < "2020-07-01")
         # cond2 = (df[["usa", "wetbulb5.0_filter"]].sum(axis = 1) > 0.0)
-        cond2 = df["wetbulb5.0_filter"] == 0.0
-        cond3 = df["usa"] == 1.0
-        df = df[cond2 & cond3].copy()
+        qc_filter = (pads.field("wetbulb5.0_filter") == 0.0) & (pads.field("usa") == 1.0)
+        df = _fast_read_parquet(conf["data_path"], filters=qc_filter)
         print(df.shape)
 
     elif not os.path.isfile(os.path.join(conf["data_path"], "cached.parquet")):
         df = pd.concat(
             [
-                pd.read_parquet(x)
+                _fast_read_parquet(x)
                 for x in tqdm(glob.glob(os.path.join(conf["data_path"], "*.parquet")))
             ]
         )
         df.to_parquet(os.path.join(conf["data_path"], "cached.parquet"))
 
     else:
-        df = pd.read_parquet(os.path.join(conf["data_path"], "cached.parquet"))
+        df = _fast_read_parquet(os.path.join(conf["data_path"], "cached.parquet"))
 
     # Drop mixed cases
     if drop_mixed:
         logger.info("Dropping data points with mixed observations")
-        c1 = df["ra_percent"] == 1.0
-        c2 = df["sn_percent"] == 1.0
-        c3 = df["pl_percent"] == 1.0
-        c4 = df["fzra_percent"] == 1.0
-        condition = c1 | c2 | c3 | c4
-        df = df[condition].copy()
+        ptype_percents = df[["ra_percent", "sn_percent", "pl_percent", "fzra_percent"]].to_numpy()
+        condition = (ptype_percents == 1.0).any(axis=1)
+        df = df.take(np.flatnonzero(condition))
 
     # Split and preprocess the data
-    df["day"] = df["datetime"].apply(lambda x: str(x).split(" ")[0])
+    df["day"] = pd.to_datetime(df["datetime"]).values.astype("datetime64[D]").astype(str)
     df["id"] = range(df.shape[0])
     test_days = [day for case in conf["case_studies"].values() for day in case]
-    test_days_c = df["day"].isin(test_days)
+    test_days_c = df["day"].isin(test_days).to_numpy()
+    trainable_data = df.take(np.flatnonzero(~test_days_c))
 
     # Need the same test_data for all trained models (data and model ensembles)
     gsp = GroupShuffleSplit(
@@ -210,13 +238,13 @@ def load_ptype_data_day(conf, data_split=0, verbose=0, drop_mixed=False):
         random_state=conf["seed"],
         train_size=conf["train_size1"],
     )
-    splits = list(gsp.split(df[~test_days_c], groups=df[~test_days_c]["day"]))
+    splits = list(gsp.split(trainable_data, groups=trainable_data["day"]))
     train_index, test_index = splits[0]
     train_data, test_data = (
-        df[~test_days_c].iloc[train_index].copy(),
-        df[~test_days_c].iloc[test_index].copy(),
+        trainable_data.take(train_index),
+        trainable_data.take(test_index),
     )
-    test_data = pd.concat([test_data, df[test_days_c].copy()])
+    test_data = pd.concat([test_data, df.take(np.flatnonzero(test_days_c))])
 
     # Make N train-valid splits using day as grouping variable, return "data_split" split
     gsp = GroupShuffleSplit(
@@ -228,8 +256,8 @@ def load_ptype_data_day(conf, data_split=0, verbose=0, drop_mixed=False):
 
     train_index, valid_index = splits[data_split]
     train_data, valid_data = (
-        train_data.iloc[train_index].copy(),
-        train_data.iloc[valid_index].copy(),
+        train_data.take(train_index),
+        train_data.take(valid_index),
     )
 
     if verbose:
@@ -284,8 +312,6 @@ def preprocess_data(
     scalers, scaled_data = {}, {}
     scalers["input"] = scalar_obs[scaler_type]
     scalers["output_label"] = LabelEncoder()
-    if encoder_type == "onehot":
-        scalers["output_onehot"] = OneHotEncoder(sparse=False)
 
     if groupby and "quantile" not in scaler_type:
         scaled_data["train_x"] = pd.DataFrame(
@@ -327,20 +353,12 @@ def preprocess_data(
         )
 
     if encoder_type == "onehot":
-        scalers["output_onehot"] = OneHotEncoder(sparse=False)
-        scaled_data["train_y"] = scalers["output_onehot"].fit_transform(
-            np.expand_dims(scaled_data["train_y"], 1)
-        )
-        scaled_data["val_y"] = scalers["output_onehot"].transform(
-            np.expand_dims(scaled_data["val_y"], 1)
-        )
-        scaled_data["test_y"] = scalers["output_onehot"].transform(
-            np.expand_dims(scaled_data["test_y"], 1)
-        )
+        onehot = np.eye(scalers["output_label"].classes_.size, dtype=np.float32)
+        scaled_data["train_y"] = onehot[scaled_data["train_y"]]
+        scaled_data["val_y"] = onehot[scaled_data["val_y"]]
+        scaled_data["test_y"] = onehot[scaled_data["test_y"]]
         if "left_overs" in data:
-            scaled_data["left_overs_y"] = scalers["output_onehot"].transform(
-                np.expand_dims(scaled_data["left_overs_y"], 1)
-            )
+            scaled_data["left_overs_y"] = onehot[scaled_data["left_overs_y"]]
 
     return scaled_data, scalers
 
@@ -348,10 +366,14 @@ def preprocess_data(
 def reshape_data_1dCNN(
     data, base_variables=["TEMP_C", "T_DEWPOINT_C", "UGRD_m/s", "VGRD_m/s"], n_levels=67
 ):
-    arr = np.zeros(shape=(data.shape[0], n_levels, len(base_variables))).astype(
-        "float32"
-    )
-    for i, var in enumerate(base_variables):
-        profile_vars = [x for x in list(data.columns) if var in x]
-        arr[:, :, i] = data[profile_vars].values.astype("float32")
-    return arr
+    columns = list(data.columns)
+    profile_vars = []
+    for var in base_variables:
+        var_columns = [x for x in columns if var in x]
+        if len(var_columns) != n_levels:
+            raise ValueError(f"Expected {n_levels} profile columns for {var}, found {len(var_columns)}")
+        profile_vars.append(var_columns)
+    # Interleave level-major so the single float32 copy is already laid out as (N, n_levels, n_vars)
+    level_major = [var_columns[i] for i in range(n_levels) for var_columns in profile_vars]
+    arr = data[level_major].to_numpy(dtype="float32")
+    return arr.reshape(-1, n_levels, len(base_variables))
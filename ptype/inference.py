@@ -3,6 +3,7 @@ from herbie import Herbie
 from metpy.units import units
 from metpy.calc import dewpoint_from_relative_humidity, dewpoint_from_specific_humidity
 import numpy as np
+import tensorflow as tf
 import xarray as xr
 import cfgrib
 import os
@@ -11,29 +12,30 @@ from evml.keras.models import CategoricalDNN
 import yaml
 import numba
 from numba import jit
-import glob
 import json
 import zarr
 import pygrib
 from pyproj import CRS, Transformer
 
-def df_flatten(ds, varsP, vertical_level_name='isobaricInhPa'):
-    """  Split pressure level variables by pressure level, reassign and return as flattened Dataframe.
+def flatten_levels(ds, varsP, vertical_level_name='isobaricInhPa'):
+    """  Flatten pressure level variables across the grid into a single contiguous array.
     Args:
         ds (xr.dataset): Dataset of pressure level variables
         varsP (list): List of pressure level variables to flatten
         vertical_level_name (str): Name of the pressure level dimension
     Returns:
-         Pandas Dataframe of flattened variables split out by variable name in format: <varName>_<pressure_level>
+         float32 array of shape (n_cells, n_levels, n_vars), dictionary mapping variable name to its index along the
+         last axis (so that arr[:, :, var_index[v]] is a zero-copy view of variable v)
     """
-    pressure_lev_data, cols = [], []
-    for v in varsP:
-        for p in ds[vertical_level_name].values:
-            cols.append(f"{v}_{int(p)}")
-            pressure_lev_data.append(ds[v].sel(isobaricInhPa=p).values.reshape(-1, 1))
-    flat_data = np.concatenate(pressure_lev_data, axis=1)
+    n_levels = ds[vertical_level_name].size
+    n_cells = ds['y'].size * ds['x'].size
+    flat_data = np.empty(shape=(n_cells, n_levels, len(varsP)), dtype=np.float32)
+    for i, v in enumerate(varsP):
+        arr = np.ascontiguousarray(ds[v].transpose(vertical_level_name, 'y', 'x').values)
+        flat_data[:, :, i] = arr.reshape(n_levels, -1).T
+    var_index = {v: i for i, v in enumerate(varsP)}
 
-    return pd.DataFrame(flat_data, columns=cols)
+    return flat_data, var_index
 
 
 def kelvin_to_celsius(temp):
@@ -66,43 +68,39 @@ def download_data(date, model, product, save_dir, forecast_hour):
 
 def load_data(var_dict, file, model, drop):
     """
-    Load variables from grib file, flatten pressure variables and convert to DataFrame. Supports "gfs", "rap", "hrrr"
-    and "nam" models.
+    Load variables from grib file and flatten pressure variables into an (n_cells, n_levels, n_vars) array. Supports
+    "gfs", "rap", "hrrr" and "nam" models.
     Args:
         var_dict: Dictionary of variables to process. Requires "isobaricInPa", "surface", and "heightAboveGround"
         file: Path to grib file.
         model: Model name. Supports "gfs", "rap", "hrrr" and "nam".
-        drop: Whether to drop pressure level variables for final written output (not dropped from flattened df).
+        drop: Whether to drop pressure level variables for final written output (not dropped from flattened array).
 
     Returns:
-        xarray dataset, flatten pandas dataframe, surface data (flattened df)
+        xarray dataset, flattened pressure level array, variable index of flattened array, surface data (flattened)
     """
+    requested = {(key, var) for key, value in var_dict.items() if key != "product" for var in value}
     grib_data = []
-    for key, value in var_dict.items():
-        if key == "product":
-            continue
-        for var in value:
-            grib = cfgrib.open_dataset(file, backend_kwargs={
-                "filter_by_keys": {'typeOfLevel': key, 'cfVarName': var, 'stepType': 'instant'}})
-            if len(grib) == 0:
-                grib = cfgrib.open_dataset(file, backend_kwargs={
-                    "filter_by_keys": {'typeOfLevel': key, 'shortName': var, 'stepType': 'instant'}})
-            grib_data.append(grib)
-
-    for idx in glob.glob(str(file) + '*.idx'):
-        os.remove(idx)  # delete index files that are created when opening grib
+    # Scan the file once and select requested variables by (typeOfLevel, cfVarName or shortName)
+    # indexpath='' keeps cfgrib from writing .idx sidecar files next to the grib file
+    for group in cfgrib.open_datasets(file, backend_kwargs={"filter_by_keys": {'stepType': 'instant'},
+                                                            "indexpath": ''}):
+        for name, da in group.data_vars.items():
+            level_type = da.attrs.get('GRIB_typeOfLevel')
+            if ((level_type, da.attrs.get('GRIB_cfVarName')) in requested or
+                    (level_type, da.attrs.get('GRIB_shortName')) in requested):
+                grib_data.append(group[[name]])
+
     nwp_dataset = xr.merge(grib_data, compat='override').load()
     nwp_dataset['t'].values = kelvin_to_celsius(nwp_dataset['t'].values)
     if model == "rap":
         nwp_dataset['dpt'] = dewpoint_from_relative_humidity(nwp_dataset['t'] * units.degC,
                                                              nwp_dataset['r'].values / 100)
     elif model == "gfs":
-        z = np.zeros(shape=(nwp_dataset['isobaricInhPa'].size,
-                            nwp_dataset['latitude'].size,
-                            nwp_dataset['longitude'].size))
-        for i in range(z.shape[1]):
-            for j in range(z.shape[2]):
-                z[:, i, j] = nwp_dataset['isobaricInhPa'].values
+        pres = nwp_dataset['isobaricInhPa'].values.astype(np.float32)
+        z = np.broadcast_to(pres.reshape(-1, 1, 1), (pres.size,
+                                                     nwp_dataset['latitude'].size,
+                                                     nwp_dataset['longitude'].size))
         dpt = dewpoint_from_specific_humidity(z * units.hPa,
                                               nwp_dataset['t'].values * units.degC,
                                               nwp_dataset['q'].values * units('kg/kg'))
@@ -111,7 +109,7 @@ def load_data(var_dict, file, model, drop):
     else:
         nwp_dataset['dpt'].values = kelvin_to_celsius(nwp_dataset['dpt'].values)
     nwp_dataset['hgt_above_sfc'] = nwp_dataset['gh'] - nwp_dataset['orog']
-    flattened_df = df_flatten(nwp_dataset, ['t', 'dpt', 'u', 'v', 'hgt_above_sfc'])
+    flattened_data, var_index = flatten_levels(nwp_dataset, ['t', 'dpt', 'u', 'v', 'hgt_above_sfc'])
 
     surface_vars = {x: nwp_dataset[x].values.flatten() for x in var_dict["heightAboveGround"] + var_dict["surface"]}
     surface_vars['t2m'] = kelvin_to_celsius(surface_vars['t2m'])
@@ -122,9 +120,9 @@ def load_data(var_dict, file, model, drop):
 
     if drop:
         dropped = var_dict["isobaricInhPa"] + ['hgt_above_sfc'] + ['dpt']
-        return nwp_dataset.drop_vars(dropped), flattened_df, surface_vars
+        return nwp_dataset.drop_vars(dropped), flattened_data, var_index, surface_vars
     else:
-        return nwp_dataset, flattened_df, surface_vars
+        return nwp_dataset, flattened_data, var_index, surface_vars
 
 
 def add_coord_data(file_path, grib_data):
@@ -158,51 +156,68 @@ def add_coord_data(file_path, grib_data):
         return grib_data
 
 
-def convert_and_interpolate(data, surface_data, pressure_levels, height_levels):
+def convert_and_interpolate(data, var_index, surface_data, height_levels):
     """
     Convert Pressure level data to height above surface and interpolate data across specified height levels.
     Args:
-        data: Pandas DataFrame of flattened pressure level data.
-        surface_data: Pandas DataFrame of flattened surface data.
-        pressure_levels: List of pressure levels from model.
+        data: Array of flattened pressure level data (n_cells, n_levels, n_vars) from flatten_levels.
+        var_index: Dictionary mapping variable name to its index along the last axis of data.
+        surface_data: Dictionary of flattened surface data.
         height_levels: Dictionary of height levels (low, high, interval)
 
     Returns:
-        Pandas Dataframe of interpolated data at height above the surface.
+        Array of interpolated data at height above the surface.
     """
-    cols = {}
     height_levels = np.arange(start=height_levels["low"],
                               stop=height_levels["high"] + height_levels["interval"],
                               step=height_levels["interval"])
-    for var in ['t', 'dpt', 'u', 'v', 'hgt_above_sfc']:
-        cols[var] = [f"{var}_{int(x)}" for x in pressure_levels]
 
-    var_arrays = []
     variables = ['t', 'dpt', 'u', 'v']
     surface_variables = ['t2m', 'd2m', 'u10', 'v10']
-    height_data = data[cols['hgt_above_sfc']].values
-
-    for v, sv in zip(variables, surface_variables):
-        pressure_level_data = data[cols[v]].values
-        height_interp_data = interpolate(height_data, pressure_level_data, height_levels)
+    n_heights = height_levels.size
+    height_data = data[:, :, var_index['hgt_above_sfc']]
+    all_data = np.empty(shape=(height_data.shape[0], n_heights * len(variables)))
+
+    for k, (v, sv) in enumerate(zip(variables, surface_variables)):
+        pressure_level_data = data[:, :, var_index[v]]
+        height_interp_data = all_data[:, k * n_heights:(k + 1) * n_heights]
+        interpolate(height_data, pressure_level_data, height_levels, height_interp_data)
         height_interp_data[:, 0] = surface_data[sv]
-        var_arrays.append(height_interp_data)
-
-    all_data = np.concatenate(var_arrays, axis=1)
 
     return all_data
 
 
 @jit(nopython=True, parallel=True, cache=True)
-def interpolate(x, y, height_levels):
+def interpolate(x, y, height_levels, out):
+    """
+    Linearly interpolate each row of y from heights x onto height_levels, equivalent to np.interp per row. Both x (per
+    row) and height_levels must be monotonically increasing, so a single forward scan over x serves every query.
+    Compiled without fastmath: the scan relies on comparisons with NaN being False, so NaN heights stop the scan and
+    propagate NaN into the output instead of reading past the end of the row.
+    Args:
+        x: 2D array of heights (n_profiles, n_levels).
+        y: 2D array of values at heights x (n_profiles, n_levels).
+        height_levels: 1D array of heights to interpolate to.
+        out: Preallocated 2D array (n_profiles, len(height_levels)) to write results into.
 
-    arr = np.zeros(shape=(x.shape[0], len(height_levels)))
+    Returns:
+        out
+    """
+    n_x = x.shape[1]
+    for i in numba.prange(out.shape[0]):
+        j = 0
+        for k in range(height_levels.shape[0]):
+            h = height_levels[k]
+            if h <= x[i, 0]:
+                out[i, k] = y[i, 0]
+            elif h >= x[i, n_x - 1]:
+                out[i, k] = y[i, n_x - 1]
+            else:
+                while x[i, j + 1] < h:
+                    j += 1
+                out[i, k] = y[i, j] + (y[i, j + 1] - y[i, j]) * (h - x[i, j]) / (x[i, j + 1] - x[i, j])
+    return out
 
-    for i in numba.prange(arr.shape[0]):
-        arr[i] = np.interp(x=height_levels,
-                           xp=x[i],
-                           fp=y[i])
-    return arr
 
 def transform_data(input_data, transformer):
     """
@@ -219,49 +234,164 @@ def transform_data(input_data, transformer):
     return transformed_data.values
 
 
-def load_model(model_path, model_file, input_scaler_file, output_scaler_file):
+def load_model(model_path, model_file, input_scaler_file, output_scaler_file, batch_size=1000, tflite_threads=None):
     """
-    Load ML model and bridgescaler object.
+    Load ML model and bridgescaler object. If model_file is a ".tflite" file the quantized TFLite model is loaded
+    instead of the Keras weights.
     Args:
         model_path: Path to ML model.
+        model_file: Name of the Keras weights (.h5) or TFLite (.tflite) file in <model_path>/models.
+        input_scaler_file: Name of the input bridgescaler file in <model_path>/scalers.
+        output_scaler_file: Name of the output label encoder file in <model_path>/scalers.
+        batch_size: Number of rows per forward pass in predict_fn.
+        tflite_threads: Number of CPU threads for the TFLite interpreter (None uses the TFLite default).
 
     Returns:
-        Loaded Tensorflow model, bridgescaler object
+        Loaded model (exposing predict_fn), bridgescaler object
     """
+    x_transformer = load_scaler(os.path.join(model_path, "scalers", input_scaler_file))
+    if model_file.endswith(".tflite"):
+        return TFLiteModel(os.path.join(model_path, "models", model_file),
+                           batch_size=batch_size,
+                           num_threads=tflite_threads), x_transformer
+
     config = os.path.join(model_path, "model.yml")
     with open(config) as cf:
         conf = yaml.load(cf, Loader=yaml.FullLoader)
-        conf['batch_size'] = 1000
 
-    x_transformer = load_scaler(os.path.join(model_path, "scalers", input_scaler_file))
     with open(os.path.join(model_path, "scalers", output_scaler_file)) as f:
         output_scaler = json.load(f)
     model = CategoricalDNN(**conf["model"])
     model.build_neural_network(len(x_transformer.x_columns_), len(output_scaler['classes_']))
     model.model.load_weights(os.path.join(model_path, "models", model_file))
+    model.predict_fn = xla_predict_fn(model.model, batch_size)
 
     return model, x_transformer
 
 
+def xla_predict_fn(keras_model, batch_size):
+    """
+    Build a batched, XLA-compiled forward pass that skips the Keras predict loop. The network is traced once for a
+    fixed (batch_size, n_inputs) shape; the final partial batch is zero-padded so activations stay bounded by
+    batch_size regardless of how many rows are passed in.
+    Args:
+        keras_model: Keras model to call with training=False.
+        batch_size: Number of rows per forward pass.
+
+    Returns:
+        Function mapping a 2D input array to a 2D float32 array of model outputs.
+    """
+    n_inputs = keras_model.input_shape[-1]
+    forward = tf.function(lambda x: keras_model(x, training=False),
+                          input_signature=[tf.TensorSpec(shape=(batch_size, n_inputs), dtype=tf.float32)],
+                          jit_compile=True)
+
+    def predict_fn(x):
+        return predict_in_batches(lambda batch: forward(tf.constant(batch)).numpy(),
+                                  x, batch_size, n_inputs, keras_model.output_shape[-1])
+
+    return predict_fn
+
+
+def predict_in_batches(forward, x, batch_size, n_inputs, n_outputs):
+    """
+    Run forward over x in fixed (batch_size, n_inputs) float32 batches, zero-padding the final partial batch.
+    Args:
+        forward: Function mapping a (batch_size, n_inputs) array to a (batch_size, n_outputs) array.
+        x: 2D array of model inputs.
+        batch_size: Number of rows per forward pass.
+        n_inputs: Number of input features.
+        n_outputs: Number of model outputs.
+
+    Returns:
+        2D float32 array of model outputs (x.shape[0], n_outputs).
+    """
+    preds = np.empty(shape=(x.shape[0], n_outputs), dtype=np.float32)
+    batch = np.zeros(shape=(batch_size, n_inputs), dtype=np.float32)
+    for start in range(0, x.shape[0], batch_size):
+        end = min(start + batch_size, x.shape[0])
+        batch[:end - start] = x[start:end]
+        batch[end - start:] = 0
+        preds[start:end] = forward(batch)[:end - start]
+    return preds
+
+
+class TFLiteModel(object):
+    """
+    Wrapper around a TFLite interpreter exposing the same predict_fn interface as the Keras model from load_model. The
+    interpreter input is sized once to (batch_size, n_inputs) and inputs are run through it in batches, so activation
+    memory is bounded by batch_size.
+    Args:
+        model_file: Path to .tflite file.
+        batch_size: Number of rows per interpreter invocation.
+        num_threads: Number of CPU threads used by the interpreter (None uses the TFLite default).
+    """
+    def __init__(self, model_file, batch_size=1000, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_file, num_threads=num_threads)
+        input_details = self.interpreter.get_input_details()[0]
+        self.input_index = input_details["index"]
+        self.n_inputs = int(input_details["shape"][-1])
+        self.batch_size = batch_size
+        self.interpreter.resize_tensor_input(self.input_index, (batch_size, self.n_inputs))
+        self.interpreter.allocate_tensors()
+        output_details = self.interpreter.get_output_details()[0]
+        self.output_index = output_details["index"]
+        self.n_outputs = int(output_details["shape"][-1])
+
+    def _forward(self, batch):
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+    def predict_fn(self, x):
+        return predict_in_batches(self._forward, x, self.batch_size, self.n_inputs, self.n_outputs)
+
+
+def convert_to_tflite(model, representative_data, out_file, n_samples=1000):
+    """
+    Post-training quantization of a trained Keras model to an int8 TFLite model.
+    Args:
+        model: Keras model (e.g. CategoricalDNN.model).
+        representative_data: Array of transformed model inputs used to calibrate activation ranges.
+        out_file: Path to write .tflite file.
+        n_samples: Number of rows of representative_data used for calibration.
+
+    Returns:
+        None
+    """
+    def representative_dataset():
+        for row in representative_data[:n_samples]:
+            yield [row.reshape(1, -1).astype(np.float32)]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    with open(out_file, "wb") as f:
+        f.write(converter.convert())
+
+    return
+
+
 def grid_predictions(data, preds):
     """
     Populate gridded xarray dataset with ML probabilities and categorical predictions as separate variables.
     Args:
         data: Xarray dataset of input data.
-        preds: Pandas Dataframe of ML predictions.
+        preds: Array of ML probabilities (n_cells, n_classes).
 
     Returns:
         Xarray dataset of ML predictions and surface variables on model grid.
     """
-    ptype = preds.argmax(axis=1).reshape(-1, 1)
-    preds = np.hstack([preds, ptype])
-    reshaped_preds = preds.reshape(data['y'].size, data['x'].size, preds.shape[-1])
+    ny, nx = data['y'].size, data['x'].size
+    probs = preds.reshape(ny, nx, preds.shape[-1]).astype('float32', copy=False)
+    ptype = probs.argmax(axis=-1).astype('uint8')
+    categorical = (ptype[..., None] == np.arange(probs.shape[-1], dtype='uint8')).astype('uint8')
     for i, (long_v, v) in enumerate(zip(
             ['rain', 'snow', 'ice pellets', 'freezing rain'], ['rain', 'snow', 'icep', 'frzr'])):
 
-        data[f"ML_{v}"] = (['y', 'x'], reshaped_preds[:, :, i].astype('float32'))                       # ML probability
+        data[f"ML_{v}"] = (['y', 'x'], probs[:, :, i])                      # ML probability
         data[f"ML_{v}"].attrs = {"Description": f"Machine Learned Probability of {long_v}"}
-        data[f"ML_c{v}"] = (['y', 'x'], np.where(reshaped_preds[:, :, -1] == i, 1, 0).astype('uint8'))  # ML categorical
+        data[f"ML_c{v}"] = (['y', 'x'], categorical[:, :, i])               # ML categorical
         data[f"ML_c{v}"].attrs = {"Description": f"Machine Learned Categorical {long_v}"}
 
     for var in ["crain", "csnow", "cicep", "cfrzr"]:
@@ -303,12 +433,22 @@ def save_data(dataset, out_path, date, model, forecast_hour, save_format):
     dataset = dataset.expand_dims('time')
 
     encoding_vars = [v for v in list(dataset.data_vars)]
+    chunks = {var: tuple(1 if dim == 'time' else min(100, dataset.sizes[dim]) for dim in dataset[var].dims)
+              for var in encoding_vars}
     if save_format == "netcdf":
-        encoding = {var: {"zlib": True, "complevel": 4, "least_significant_digit": 4} for var in encoding_vars}
-        dataset.to_netcdf(full_path + ".nc", encoding=encoding)
+        # Same quantization netCDF4 applies for least_significant_digit=4 (not supported by h5netcdf): round floats to
+        # a multiple of 2**-14 so trailing mantissa bits are zero and compress well
+        scale = 2.0 ** int(np.ceil(np.log2(10.0 ** 4)))
+        for var in encoding_vars:
+            values = dataset[var].values
+            if np.issubdtype(values.dtype, np.floating):
+                dataset[var] = dataset[var].copy(data=(np.around(values * scale) / scale).astype(values.dtype))
+        encoding = {var: {"compression": "gzip", "compression_opts": 4, "shuffle": True, "chunksizes": chunks[var]}
+                    for var in encoding_vars}
+        dataset.to_netcdf(full_path + ".nc", engine="h5netcdf", encoding=encoding)
     elif save_format == "zarr":
-        compressor = zarr.Blosc(cname="zlib", clevel=4, shuffle=1)
-        encoding = {var: {'compressor': compressor, 'chunks': {100, 100}} for var in encoding_vars}
+        compressor = zarr.Blosc(cname="zstd", clevel=3, shuffle=zarr.Blosc.BITSHUFFLE)
+        encoding = {var: {'compressor': compressor, 'chunks': chunks[var]} for var in encoding_vars}
         dataset.to_zarr(full_path + ".zarr", mode='w', encoding=encoding, consolidated=True)
     print(f"Successfully wrote: {full_path}")
 
@@ -1,10 +1,13 @@
 import argparse
 import os
 import yaml
+import numpy as np
 import pandas as pd
 from ptype.inference import download_data, load_data, convert_and_interpolate
 from ptype.inference import load_model, transform_data, grid_predictions, save_data
 import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 from dask.distributed import Client
 from dask_jobqueue import PBSCluster
@@ -13,31 +16,45 @@ from dask_jobqueue import PBSCluster
 def main(config, username, date, forecast_hour):
 
     out_path = config["out_path"].replace("username", username)
-    nwp_model = config["model"]
     model, transformer = load_model(model_path=config["ML_model_path"],
                                     model_file=config["model_file"],
                                     input_scaler_file=config["input_scaler_file"],
-                                    output_scaler_file=config["output_scaler_file"])
+                                    output_scaler_file=config["output_scaler_file"],
+                                    tflite_threads=config.get("tflite_threads"))
     file = download_data(date=date,
                          model=config["model"],
-                         product=config["variables"]["model"][nwp_model]["product"],
+                         product=config["variables"]["model"][config["model"]]["product"],
                          save_dir=out_path,
                          forecast_hour=forecast_hour)
+    predict_file(config, model, transformer, out_path, file, date, forecast_hour)
 
-    ds, df, surface_vars = load_data(var_dict=config["variables"]["model"][nwp_model],
-                                     file=file,
-                                     model=nwp_model,
-                                     drop=config["drop_input_data"])
 
-    data = convert_and_interpolate(data=df,
-                                   surface_data=surface_vars,
-                                   pressure_levels=ds["isobaricInhPa"],
-                                   height_levels=config["height_levels"])
+def predict_file(config, model, transformer, out_path, file, date, forecast_hour):
 
-    x_data = transform_data(input_data=data,
-                            transformer=transformer)
+    nwp_model = config["model"]
+    ds, flat_data, var_index, surface_vars = load_data(var_dict=config["variables"]["model"][nwp_model],
+                                                       file=file,
+                                                       model=nwp_model,
+                                                       drop=config["drop_input_data"])
+
+    n_cells = flat_data.shape[0]
+    chunk_size = config.get("chunk_size", n_cells)
+    predictions = None
+    for start in range(0, n_cells, chunk_size):
+        end = min(start + chunk_size, n_cells)
+        data = convert_and_interpolate(data=flat_data[start:end],
+                                       var_index=var_index,
+                                       surface_data={k: v[start:end] for k, v in surface_vars.items()},
+                                       height_levels=config["height_levels"])
+        x_data = transform_data(input_data=data,
+                                transformer=transformer)
+        chunk_preds = model.predict_fn(x_data)
+        if predictions is None:
+            predictions = np.empty(shape=(n_cells, chunk_preds.shape[1]), dtype=np.float32)
+        predictions[start:end] = chunk_preds
+        del data, x_data, chunk_preds
+    del flat_data, surface_vars
 
-    predictions = model.predict(x_data)
     gridded_preds = grid_predictions(data=ds,
                                     preds=predictions)
     save_data(dataset=gridded_preds,
@@ -46,7 +63,47 @@ def main(config, username, date, forecast_hour):
               model=config["model"],
               forecast_hour=forecast_hour,
               save_format=config["save_format"])
-    del ds, df, surface_vars, data, x_data, predictions, gridded_preds
+    del ds, predictions, gridded_preds
+
+
+worker_model = {}
+
+
+def init_worker(config):
+    """ Load the ML model and scaler once per worker process. """
+    worker_model["model"], worker_model["transformer"] = load_model(model_path=config["ML_model_path"],
+                                                                    model_file=config["model_file"],
+                                                                    input_scaler_file=config["input_scaler_file"],
+                                                                    output_scaler_file=config["output_scaler_file"],
+                                                                    tflite_threads=config.get("tflite_threads"))
+
+
+def predict_worker(config, out_path, file, date, forecast_hour):
+
+    predict_file(config, worker_model["model"], worker_model["transformer"], out_path, file, date, forecast_hour)
+
+
+def prefetch_downloads(config, out_path, run_args, n_prefetch):
+    """
+    Download grib files in background threads, keeping up to n_prefetch downloads in flight ahead of the consumer.
+    Yields (date, forecast_hour, file) in the order of run_args.
+    """
+    product = config["variables"]["model"][config["model"]]["product"]
+    with ThreadPoolExecutor(max_workers=n_prefetch) as executor:
+        pending = deque()
+        for date, forecast_hour in run_args:
+            pending.append((date, forecast_hour, executor.submit(download_data,
+                                                                 date=date,
+                                                                 model=config["model"],
+                                                                 product=product,
+                                                                 save_dir=out_path,
+                                                                 forecast_hour=forecast_hour)))
+            if len(pending) > n_prefetch:
+                date, forecast_hour, future = pending.popleft()
+                yield date, forecast_hour, future.result()
+        while pending:
+            date, forecast_hour, future = pending.popleft()
+            yield date, forecast_hour, future.result()
 
 
 if __name__ == "__main__":
@@ -66,10 +123,9 @@ if __name__ == "__main__":
                            config["forecast_range"]["end"] + config["forecast_range"]["interval"],
                            config["forecast_range"]["interval"])
 
-    main_args = itertools.product([config], [username], dates, forecast_hours)
-
     if config["use_dask"]:
 
+        main_args = itertools.product([config], [username], dates, forecast_hours)
         cluster = PBSCluster(**config["dask_params"]["PBS"])
         client = Client(cluster)
         cluster.scale(jobs=config["dask_params"]["n_jobs"])
@@ -80,5 +136,19 @@ if __name__ == "__main__":
         _ = [tasks[i].result() for i in range(len(tasks))]
 
     else:
-        with Pool(processes=config["n_processors"]) as pool:
-            pool.starmap(main, main_args)
+        # Decode / predict / write in a process pool that loads the model once per worker, while grib downloads
+        # run ahead in background threads
+        out_path = config["out_path"].replace("username", username)
+        n_processors = config["n_processors"]
+        n_prefetch = config.get("n_prefetch", n_processors)
+        run_args = itertools.product(dates, forecast_hours)
+        # Create the pool before any download threads are started so workers are not forked from a threaded parent
+        with Pool(processes=n_processors, initializer=init_worker, initargs=(config,)) as pool:
+            tasks = deque()
+            for date, forecast_hour, file in prefetch_downloads(config, out_path, run_args, n_prefetch):
+                tasks.append(pool.apply_async(predict_worker, (config, out_path, file, date, forecast_hour)))
+                # Bound the number of downloaded files waiting on disk for a free worker
+                if len(tasks) >= n_processors + n_prefetch:
+                    tasks.popleft().get()
+            while tasks:
+                tasks.popleft().get()
@@ -0,0 +1,65 @@
+from ptype.inference import interpolate, xla_predict_fn, convert_to_tflite, TFLiteModel
+import numpy as np
+import tensorflow as tf
+
+
+def tiny_model(n_inputs=6, n_outputs=4):
+    return tf.keras.Sequential([
+        tf.keras.Input(shape=(n_inputs,)),
+        tf.keras.layers.Dense(8, activation="relu"),
+        tf.keras.layers.Dense(n_outputs, activation="softmax"),
+    ])
+
+
+def test_interpolate():
+    rng = np.random.default_rng(1000)
+    n_profiles, n_levels = 50, 20
+    # Heights start below ground and top out below the highest query to exercise both clamped edges
+    heights = np.sort(rng.uniform(-200, 15000, size=(n_profiles, n_levels)), axis=1)
+    values = rng.normal(size=(n_profiles, n_levels))
+    height_levels = np.arange(0, 16500 + 250, 250)
+    heights[0] = np.arange(-250, -250 + 750 * n_levels, 750)  # node at 500 m is also a query height
+
+    # Strided views, as passed by convert_and_interpolate
+    stacked = np.stack([heights, values], axis=-1).astype(np.float32)
+    x, y = stacked[:, :, 0], stacked[:, :, 1]
+    all_data = np.zeros(shape=(n_profiles, 2 * height_levels.size))
+    out = all_data[:, height_levels.size:]
+
+    result = interpolate(x, y, height_levels, out)
+    expected = np.stack([np.interp(height_levels, x[i], y[i]) for i in range(n_profiles)])
+    assert result is out, "Output not written into the provided buffer"
+    assert np.allclose(all_data[:, height_levels.size:], expected, atol=1e-5), "Does not match np.interp"
+    assert np.all(all_data[:, :height_levels.size] == 0), "Wrote outside the output view"
+    assert np.allclose(out[:, -1], y[:, -1]), "Not clamped above highest height"
+    assert np.isclose(out[0, 2], y[0, 1]), "Incorrect value on a node"
+
+
+def test_interpolate_below_surface():
+    x = np.array([[100.0, 200.0, 300.0]])
+    y = np.array([[1.0, 2.0, 3.0]])
+    out = np.empty(shape=(1, 3))
+    interpolate(x, y, np.array([0, 50, 150]), out)
+    assert np.allclose(out, [[1.0, 1.0, 1.5]]), "Not clamped below lowest height"
+
+
+def test_xla_predict_fn():
+    model = tiny_model()
+    x = np.random.default_rng(1000).normal(size=(25, 6)).astype(np.float32)  # not a multiple of batch_size
+    preds = xla_predict_fn(model, batch_size=10)(x)
+    assert preds.shape == (25, 4), "Incorrect output shape"
+    assert np.allclose(preds, model.predict(x, verbose=0), atol=1e-5), "Does not match model.predict"
+
+
+def test_tflite_model(tmp_path):
+    model = tiny_model()
+    rng = np.random.default_rng(1000)
+    calibration = rng.normal(size=(200, 6)).astype(np.float32)
+    x = rng.normal(size=(25, 6)).astype(np.float32)  # not a multiple of batch_size
+    tflite_file = str(tmp_path / "model.tflite")
+    convert_to_tflite(model, calibration, tflite_file, n_samples=100)
+    preds = TFLiteModel(tflite_file, batch_size=10, num_threads=1).predict_fn(x)
+    float_preds = model.predict(x, verbose=0)
+    assert preds.shape == float_preds.shape, "Incorrect output shape"
+    agreement = (preds.argmax(axis=1) == float_preds.argmax(axis=1)).mean()
+    assert agreement >= 0.8, f"Quantized argmax agrees with float model on only {agreement:.0%} of rows"